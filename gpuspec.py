@@ -3,33 +3,222 @@ import bifrost as bf
 import bifrost.pipeline as bfp
 import bifrost.blocks as blocks
 import bifrost.views as views
-import bifrost.guppi_raw as guppi_raw
+from bifrost.blocks.fft import FftBlock
+from bifrost.fft import Fft
+from bifrost.transpose import transpose as bf_transpose
 import bifrost.sigproc as sigproc
 from bifrost.DataType import DataType
+from bifrost.units import convert_units
 
 from copy import deepcopy
-
-def get_with_default(obj, key, default=None):
-	return obj[key] if key in obj else default
+from fractions import Fraction
+import errno
+import fcntl
+import mmap
+import os
+import threading
+import numpy as np
 
 def mjd2unix(mjd):
 	return (mjd - 40587) * 86400
 
+# Output header entries that do not depend on the GUPPI header
+GUPPI_STATIC_OHDR = {
+    'refdm_units':   'pc cm^-3',
+    'coord_frame':   'topocentric',
+}
+
+GUPPI_RECORD_NBYTE = 80
+GUPPI_DIRECTIO_ALIGN_NBYTE = 512
+# Number of header records fetched per read while looking for 'END'
+GUPPI_READ_NRECORD = 64
+
+def parse_guppi_value(val):
+    val = val.strip()
+    try:
+        return int(val)
+    except ValueError:
+        pass
+    try:
+        return float(val)
+    except ValueError:
+        pass
+    val = val.decode()
+    if val[:1] not in ("'", '"'):
+        raise ValueError("Invalid header value: " + val)
+    return val[1:-1].strip()
+
+class GuppiRawHeader(dict):
+    def __init__(self, records):
+        """ GUPPI header whose values are only parsed when first used
+
+        records maps each key to its raw, unparsed value.
+        """
+        super(GuppiRawHeader, self).__init__()
+        self.records = records
+    def __missing__(self, key):
+        val = parse_guppi_value(self.records[key])
+        self[key] = val
+        return val
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.records
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    def __iter__(self):
+        for key in self.records:
+            yield key
+        for key in dict.__iter__(self):
+            if key not in self.records:
+                yield key
+    def __len__(self):
+        return len(self.records) + sum(1 for key in dict.__iter__(self)
+                                       if key not in self.records)
+    def keys(self):
+        return list(self)
+    def values(self):
+        return [self[key] for key in self]
+    def items(self):
+        return [(key, self[key]) for key in self]
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+def read_guppi_header(f):
+    """ Read a GUPPI header from f, parsing values only when accessed """
+    start = f.tell()
+    buf = b''
+    records = {}
+    irecord = 0
+    while True:
+        if (irecord+1)*GUPPI_RECORD_NBYTE > len(buf):
+            chunk = f.read(GUPPI_READ_NRECORD*GUPPI_RECORD_NBYTE)
+            if not chunk:
+                raise IOError("EOF reached in middle of header")
+            buf += chunk
+            continue
+        record = buf[irecord*GUPPI_RECORD_NBYTE:(irecord+1)*GUPPI_RECORD_NBYTE]
+        irecord += 1
+        if record.startswith(b'END'):
+            break
+        key, sep, val = record.partition(b'=')
+        if sep:
+            records[key.strip().decode()] = val
+    end = start + irecord*GUPPI_RECORD_NBYTE
+    hdr = GuppiRawHeader(records)
+    if hdr.get('DIRECTIO'):
+        # Skip padding up to the next aligned offset
+        align = GUPPI_DIRECTIO_ALIGN_NBYTE
+        end = (end + align - 1) // align * align
+    f.seek(end)
+    if 'NPOL' in hdr:
+        # WAR for files with NPOL=4 (meaning 2 complex pols)
+        hdr['NPOL'] = 1 if hdr['NPOL'] == 1 else 2
+    if 'NTIME' not in hdr:
+        # Compute NTIME (no. time samples per block)
+        hdr['NTIME'] = hdr['BLOCSIZE'] * 8 // (hdr['OBSNCHAN'] * hdr['NPOL'] *
+                                               2 * hdr['NBITS'])
+    return hdr
+
+def madvise_range(mm, advice, start, stop):
+    """ Apply mmap.<advice> to the pages spanning [start, stop) of mm
+
+    This is a no-op where madvise is not available (Python < 3.8, non-Linux).
+    """
+    if not hasattr(mm, 'madvise') or not hasattr(mmap, advice):
+        return
+    start = start // mmap.PAGESIZE * mmap.PAGESIZE
+    stop = min(stop, len(mm))
+    if stop > start:
+        mm.madvise(getattr(mmap, advice), start, stop - start)
+
+class GuppiRawFile(object):
+    def __init__(self, filename):
+        """ Memory-mapped GUPPI raw file with all block headers pre-scanned
+
+        Every header is walked once up front, so reading data afterwards
+        needs no header parsing and no seeking through the file. Only the
+        values read_guppi_header itself needs (DIRECTIO and NPOL, plus
+        BLOCSIZE, OBSNCHAN and NBITS when there is no NTIME) and BLOCSIZE
+        are parsed during the scan.
+        """
+        # Note: The mapping stays valid after the file is closed
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.header = read_guppi_header(self.mm)
+            self.block_nbyte = self.header['BLOCSIZE']
+            data_offsets = [self.mm.tell()]
+            while True:
+                # Note: A truncated last block is dropped
+                next_header = data_offsets[-1] + self.block_nbyte
+                if next_header >= len(self.mm):
+                    if next_header > len(self.mm):
+                        data_offsets.pop()
+                    break
+                self.mm.seek(next_header)
+                try:
+                    hdr = read_guppi_header(self.mm)
+                except IOError:
+                    break # Truncated header
+                if hdr['BLOCSIZE'] != self.block_nbyte:
+                    raise IOError("Block size changes within file")
+                data_offsets.append(self.mm.tell())
+        except:
+            self.mm.close()
+            raise
+        self.data_offsets = np.array(data_offsets, dtype=np.int64)
+        self.iblock = 0
+        # Note: Only now, as the scan above jumps a whole block at a time
+        #     and would not use the readahead this enables.
+        madvise_range(self.mm, 'MADV_SEQUENTIAL', 0, len(self.mm))
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, tb):
+        self.close()
+    def close(self):
+        self.mm.close()
+    def readinto(self, obytes, nblock):
+        """ Copy the payloads of the next (up to) nblock blocks into obytes
+
+        Returns the number of blocks copied, which is 0 at EOF.
+        """
+        offsets = self.data_offsets[self.iblock:self.iblock+nblock]
+        nbyte = self.block_nbyte
+        for i, offset in enumerate(offsets):
+            obytes[i*nbyte:(i+1)*nbyte] = np.frombuffer(
+                self.mm, dtype=np.uint8, count=nbyte, offset=int(offset))
+        self.iblock += len(offsets)
+        # Have the kernel start reading the next nblock blocks in the
+        #   background while these are processed, and drop the pages already
+        #   consumed so that memory use stays bounded on very large files.
+        if len(offsets):
+            madvise_range(self.mm, 'MADV_DONTNEED',
+                          offsets[0], offsets[-1] + nbyte)
+        next_offsets = self.data_offsets[self.iblock:self.iblock+nblock]
+        if len(next_offsets):
+            madvise_range(self.mm, 'MADV_WILLNEED',
+                          next_offsets[0], next_offsets[-1] + nbyte)
+        return len(offsets)
+
 class GuppiRawSourceBlock(bfp.SourceBlock):
-    def __init__(self, sourcenames, gulp_nframe=1, *args, **kwargs):
+    def __init__(self, sourcenames, gulp_nframe=1, space='cuda_host',
+                 *args, **kwargs):
+        # Note: The output ring defaults to pinned host memory so that the
+        #     host->device copy downstream can be done asynchronously at
+        #     full PCIe bandwidth.
         super(GuppiRawSourceBlock, self).__init__(sourcenames,
                               gulp_nframe=gulp_nframe,
+                              space=space,
                               *args, **kwargs)
-        self.always_return_0 = False
     def create_reader(self, sourcename):
-        return open(sourcename, 'rb')
+        return GuppiRawFile(sourcename)
     def on_sequence(self, reader, sourcename):
-        previous_pos = reader.tell()
-        ihdr = guppi_raw.read_header(reader)
-        header_size = reader.tell() - previous_pos
-        self.header_buf = bytearray(header_size)
+        ihdr = reader.header
         nbit      = ihdr['NBITS']
         assert(nbit in set([4,8,16,32,64]))
+        # Note: Samples are never unpacked on the host. 4-bit data stays
+        #     packed (one byte per complex sample) through the H2D copy and
+        #     the pol-major reorder, and is expanded by bifrost's FFT in its
+        #     cuFFT load callback as it is read into the transform.
         nchan     = ihdr['OBSNCHAN']
         bw_MHz    = ihdr['OBSBW']
         cfreq_MHz = ihdr['OBSFREQ']
@@ -38,13 +227,18 @@ class GuppiRawSourceBlock(bfp.SourceBlock):
         # Note: This will be negative if OBSBW is negative, which is correct
         dt_s   = 1. / df_MHz / 1e6
         # Derive the timestamp of this block
+        # Note: This is done in exact rational arithmetic, as a float
+        #     cannot hold a Unix time to the resolution of time_tag.
+        #     The offset is byte_offset / (bytes per sample) * |dt_s|.
         byte_offset   = ihdr['PKTIDX'] * ihdr['PKTSIZE']
-        frame_nbyte   = ihdr['BLOCSIZE'] / ihdr['NTIME']
-        bytes_per_sec = frame_nbyte / dt_s
-        offset_secs   = byte_offset / bytes_per_sec
-        tstart_mjd    = ihdr['STT_IMJD'] + (ihdr['STT_SMJD'] + offset_secs) / 86400.
-        tstart_unix   = mjd2unix(tstart_mjd)
-        ohdr = {
+        offset_secs   = (Fraction(byte_offset * ihdr['NTIME'] * nchan,
+                                  ihdr['BLOCSIZE'] * 1000000) /
+                         abs(Fraction(bw_MHz)))
+        tstart_secs   = (Fraction(mjd2unix(ihdr['STT_IMJD'])) +
+                         Fraction(ihdr['STT_SMJD']) + offset_secs)
+        tstart_unix   = float(tstart_secs)
+        ohdr = dict(GUPPI_STATIC_OHDR)
+        ohdr.update({
             '_tensor': {
                 'dtype':  'ci' + str(nbit),
                 'shape':  [-1, nchan, ihdr['NTIME'], ihdr['NPOL']],
@@ -56,92 +250,592 @@ class GuppiRawSourceBlock(bfp.SourceBlock):
                        None],
                 'units':  ['s', 'MHz', 's', None]
             },
-            'az_start':      get_with_default(ihdr, 'AZ'),        # Decimal degrees
-            'za_start':      get_with_default(ihdr, 'ZA'),        # Decimal degrees
-            'raj':       get_with_default(ihdr, 'RA')*(24./360.), # Decimal hours
-            'dej':       get_with_default(ihdr, 'DEC'),       # Decimal degrees
-            'source_name':   get_with_default(ihdr, 'SRC_NAME'),
-            'refdm':     get_with_default(ihdr, 'CHAN_DM'),
-            'refdm_units':   'pc cm^-3',
-            'telescope':     get_with_default(ihdr, 'TELESCOP'),
-            'machine':       get_with_default(ihdr, 'BACKEND'),
+            'az_start':      ihdr.get('AZ'),        # Decimal degrees
+            'za_start':      ihdr.get('ZA'),        # Decimal degrees
+            'raj':       ihdr['RA']*(24./360.) if 'RA' in ihdr else None, # Decimal hours
+            'dej':       ihdr.get('DEC'),       # Decimal degrees
+            'source_name':   ihdr.get('SRC_NAME'),
+            'refdm':     ihdr.get('CHAN_DM'),
+            'telescope':     ihdr.get('TELESCOP'),
+            'machine':       ihdr.get('BACKEND'),
             'rawdatafile':   sourcename,
-            'coord_frame':   'topocentric',
-        }
+        })
         # Note: This gives 32 bits to the fractional part of a second,
         #     corresponding to ~0.233ns resolution. The whole part
         #     gets at least 31 bits, which will overflow in 2038.
-        time_tag  = int(round(tstart_unix * 2**32))
+        time_tag  = ((tstart_secs.numerator * 2**33 + tstart_secs.denominator) //
+                     (2 * tstart_secs.denominator)) # Rounded to nearest
         ohdr['time_tag'] = time_tag
-        self.already_read_header = True
         
         ohdr['name'] = sourcename
         return [ohdr]
     def on_data(self, reader, ospans):
-        if self.always_return_0:
-            return [0]
-        if not self.already_read_header:
-            # Skip over header
-            #ihdr = guppi_raw.read_header(reader)
-            nbyte = reader.readinto(self.header_buf)
-            if nbyte == 0:
-                return [0] # EOF
-            elif nbyte < len(self.header_buf):
-                raise IOError("Block header is truncated")
-            self.already_read_header = False
         ospan = ospans[0]
         odata = ospan.data
-        nbyte = reader.readinto(odata)
-        if nbyte % ospan.frame_nbyte:
-            #raise IOError("Block data is truncated")
-            reader.close()
-            self.always_return_0 = True
-            return [0]
-        nframe = nbyte // ospan.frame_nbyte
+        if ospan.frame_nbyte != reader.block_nbyte:
+            raise IOError("Block size does not match header")
+        nframe = reader.readinto(np.frombuffer(odata, dtype=np.uint8),
+                                 odata.shape[0])
+        # Note: Returning 0 frames at EOF is what ends the sequence; the
+        #     pipeline then closes this reader and moves to the next source.
         #print "nframe:", nframe
-        #print "nbyte:", nbyte
         return [nframe]
 
 def new_read_guppi_raw(filenames, *args, **kwargs):
     return GuppiRawSourceBlock(filenames, *args, **kwargs)
 
-class GrabFirstBlock(bfp.TransformBlock):
-    def __init__(self, iring, axis):
-        """ Square the first element of an axis """
-        super(GrabFirstBlock, self).__init__(iring)
-        self.specified_axis = axis
-    def define_valid_input_spaces(self):
-        """Return set of valid spaces (or 'any') for each input"""
-        return ('cuda',)
+def pol_major_func(ilabels, vlabels, npol):
+    """ Return (code, axis names) for a bf.map reorder from ilabels to vlabels
+
+    Only the pol axis moves. The map runs over every axis except pol: each
+    thread loads all pols of one sample, which are adjacent in the input,
+    and stores each into its own pol's series, so loads and stores are both
+    coalesced. The moving axis is only npol long, so no shared-memory tiling
+    is needed.
+    """
+    axis_names = ['i%i' % i for i in range(len(vlabels) - 1)]
+    indices = dict(zip([label for label in vlabels if label != 'pol'],
+                       axis_names))
+    stores = []
+    for pol in range(npol):
+        indices['pol'] = str(pol)
+        stores.append("b(%s) = a(%s)" % (
+            ','.join([indices[label] for label in vlabels]),
+            ','.join([indices[label] for label in ilabels])))
+    return "; ".join(stores), axis_names
+
+# Cache of generated bf.map code, keyed by everything baked into it
+_stokes_i_funcs = {}
+# Threads per coarse channel in the nbit=8 kernels
+STOKES_I_STATS_NSPLIT = 1024
+# Weight of each gulp in the running per-channel power stats for nbit=8
+STOKES_I_STATS_WEIGHT = 1 / 16.
+# Fraction of the fine channels at each edge of a coarse channel that is
+#   left out of the stats (along with DC), as the filterbank rolls off there
+STOKES_I_STATS_EDGE = 1 / 16.
+
+def stokes_i_integrate(ilabels, npol, nint):
+    """ Return code setting x to the power of output frame t, fine channel f
+
+    The sums over pols and over the nint integrated frames are unrolled,
+    and the input is indexed in its own order.
+    """
+    def power(time_index):
+        indices = {'time': time_index, 'channel': 'c', 'freq': 'f'}
+        terms = []
+        for pol in range(npol):
+            indices['pol'] = str(pol)
+            terms.append("a(%s).mag2()" % ','.join([indices[label]
+                                                    for label in ilabels]))
+        return " + ".join(terms)
+    if nint == 1:
+        return "float x = %s;" % power('t')
+    return """float x = 0;
+            #pragma unroll
+            for( int i=0; i<%i; ++i ) {
+                int ti = t*%i + i;
+                x += %s;
+            }""" % (nint, nint, power('ti'))
+
+def stokes_i_func(ilabels, npol, nint=1):
+    """ Return the bf.map code for FftStokesIBlock with nbit=32
+
+    Each distinct key generates its code once; bf.map then reuses the
+    kernel it compiled for that code.
+    """
+    key = (tuple(ilabels), npol, nint)
+    if key in _stokes_i_funcs:
+        return _stokes_i_funcs[key]
+    func = stokes_i_integrate(ilabels, npol, nint) + "\nb(c, t, p, f) = x;"
+    _stokes_i_funcs[key] = func
+    return func
+
+def stokes_i_8bit_funcs(ilabels, npol, nint, nframe, nfreq, fftshift):
+    """ Return the bf.map code (seed, quantize, update) for nbit=8
+
+    seed and quantize run over [channel, split], each thread looping over a
+    strided subset of the fine channels and summing the power and its
+    square into p, skipping DC and the band edges. quantize also maps the
+    running mean in s to 64 and one standard deviation to 32 counts.
+    update runs over channels and folds p into s with weight w.
+    """
+    key = ('8bit', tuple(ilabels), npol, nint, nframe, nfreq, fftshift)
+    if key in _stokes_i_funcs:
+        return _stokes_i_funcs[key]
+    edge = int(nfreq * STOKES_I_STATS_EDGE)
+    params = {'integrate': stokes_i_integrate(ilabels, npol, nint),
+              'nframe': nframe, 'nfreq': nfreq,
+              'nsplit': STOKES_I_STATS_NSPLIT, 'edge': edge,
+              # Offset from each fine channel's index to its fftshifted one
+              'shift': 0 if fftshift else nfreq // 2,
+              'nsample': nframe * max(nfreq - 2*edge - 1, 1)}
+    accumulate = """
+        enum { NT = %(nframe)i, NF = %(nfreq)i, NS = %(nsplit)i,
+               EDGE = %(edge)i, SHIFT = %(shift)i };
+        %(setup)s
+        double sum = 0, sumsq = 0;
+        for( int f=j; f<NF; f+=NS ) {
+            int g = (f + SHIFT) %% NF;
+            bool use = g >= EDGE && g < NF - EDGE && g != NF / 2;
+            #pragma unroll
+            for( int t=0; t<NT; ++t ) {
+                %(integrate)s
+                %(store)s
+                if( use ) {
+                    sum += x;
+                    sumsq += x*x;
+                }
+            }
+        }
+        p(c, j, 0) = sum;
+        p(c, j, 1) = sumsq;
+        """
+    seed = accumulate % dict(params, setup='', store='')
+    quantize = accumulate % dict(params, setup="""
+        double mean = s(c, 0);
+        double var  = s(c, 1) - mean*mean;
+        float scale = var > 0 ? 32. / sqrt(var) : 0.f;""", store="""
+                float q = rintf((x - (float)mean) * scale + 64.f);
+                b(c, t, 0, f) = fminf(fmaxf(q, 0.f), 255.f);""")
+    # s holds each channel's running [mean, mean square] of the power
+    update = """
+        const double NSAMPLE = %(nsample)i;
+        double sum = 0, sumsq = 0;
+        for( int j=0; j<%(nsplit)i; ++j ) {
+            sum += p(c, j, 0);
+            sumsq += p(c, j, 1);
+        }
+        s(c, 0) += w * (sum / NSAMPLE - s(c, 0));
+        s(c, 1) += w * (sumsq / NSAMPLE - s(c, 1));
+        """ % params
+    _stokes_i_funcs[key] = (seed, quantize, update)
+    return seed, quantize, update
+
+# Idle cuFFT plans, keyed by everything the plan depends on. Plans outlive
+#   the blocks (and pipelines) that created them, so a later sequence or
+#   pipeline with the same shapes skips the plan build.
+_fft_plans = {}
+_fft_plans_lock = threading.Lock()
+
+def fft_plan_key(idata, odata, axes, apply_fftshift=False):
+    return (tuple(idata.shape), tuple(idata.strides), str(idata.dtype),
+            tuple(odata.shape), tuple(odata.strides), str(odata.dtype),
+            tuple(axes), apply_fftshift)
+
+def acquire_fft_plan(key, idata, odata):
+    """ Return an FFT plan for key, building it only if none is idle
+
+    The plan is owned by the caller until it is passed to release_fft_plan,
+    so it is never executed from two block threads at once.
+    """
+    with _fft_plans_lock:
+        idle = _fft_plans.get(key)
+        if idle:
+            return idle.pop()
+    axes, apply_fftshift = key[-2:]
+    plan = Fft()
+    plan.init(idata, odata, axes=list(axes), apply_fftshift=apply_fftshift)
+    return plan
+
+def release_fft_plan(key, plan):
+    with _fft_plans_lock:
+        _fft_plans.setdefault(key, []).append(plan)
+
+class FftStokesIBlock(FftBlock):
+    def __init__(self, iring, axes, axis_labels=None, nbit=32, nint=1,
+                 *args, **kwargs):
+        """ FFT, detect Stokes I and transpose to [channel, time, pol, freq]
+
+        Sums |X|^2 over the pols of the FFT of axes, integrating each nint
+        frames (the input gulp must be a multiple of nint). nbit=8 quantizes
+        each coarse channel's running mean to 64 and std to 32 counts.
+        """
+        super(FftStokesIBlock, self).__init__(iring, axes,
+                                              axis_labels=axis_labels,
+                                              *args, **kwargs)
+        if nbit not in (8, 32):
+            raise ValueError("Unsupported output nbit: %i" % nbit)
+        self.nbit = nbit
+        self.nint = nint
+        self.oaxes = ['channel', 'time', 'pol', 'freq']
+        self.fft_axes = axes if isinstance(axes, (list, tuple)) else [axes]
+        self.fftshift = kwargs.get('apply_fftshift', False)
+        # Note: Not self.plan, which FftBlock replaces in on_sequence
+        self._fft_plan_key = None
+        self._fft_plan = None
+        self.layout = None
+    def define_output_nframes(self, input_nframe):
+        return input_nframe // self.nint
     def on_sequence(self, iseq):
-        ihdr = iseq.header
-        ohdr = deepcopy(ihdr)
-        ohdr['_tensor']['shape'][3] = 1
+        igulp_nframe = self.gulp_nframe or iseq.header['gulp_nframe']
+        if igulp_nframe % self.nint:
+            raise ValueError("Input gulp_nframe (%i) is not a multiple of "
+                             "nint (%i)" % (igulp_nframe, self.nint))
+        itensor = iseq.header['_tensor']
+        ilabels = itensor['labels']
+        fft_labels = [axis if isinstance(axis, str) else ilabels[axis]
+                      for axis in self.fft_axes]
+        # Order of the voltages as transformed: pol just before the FFT axis
+        vlabels = [label for label in ilabels if label != 'pol']
+        vlabels.insert(vlabels.index(fft_labels[0]), 'pol')
+        self.vperm = [ilabels.index(label) for label in vlabels]
+        self.reorder = vlabels != ilabels
+        self.idtype = itensor['dtype']
+        self.fft_axis_indices = [vlabels.index(label) for label in fft_labels]
+        npol = itensor['shape'][ilabels.index('pol')]
+        # Note: bf.map cannot address 4-bit samples individually
+        if self.reorder and self.idtype != 'ci4':
+            self.reorder_func, self.reorder_axes = pol_major_func(
+                ilabels, vlabels, npol)
+        else:
+            self.reorder_func = None
+        # Note: Scratch buffers and the prepared gulp carry over to the next
+        #     sequence unless its layout differs
+        layout = (tuple(ilabels), tuple(itensor['shape'][1:]), self.idtype)
+        new_layout = layout != self.layout
+        if new_layout:
+            self.layout = layout
+            self.voltages = None
+            self.spectra = None
+            self.prepared_nframe = None
+        # Header of the FFT output, which is what the detect kernel reads
+        fhdr = super(FftStokesIBlock, self).on_sequence(iseq)
+        ftensor = fhdr['_tensor']
+        self.ilabels = [ftensor['labels'][i] for i in self.vperm]
+        perm = [ftensor['labels'].index(label) for label in self.oaxes]
+        ohdr = deepcopy(fhdr)
+        otensor = ohdr['_tensor']
+        for key in ['shape', 'labels', 'scales', 'units']:
+            if key in ftensor:
+                otensor[key] = [ftensor[key][i] for i in perm]
+        otensor['dtype'] = 'f32' if self.nbit == 32 else 'u8'
+        # Stokes I is the only remaining 'pol'
+        otensor['shape'][self.oaxes.index('pol')] = 1
+        if 'scales' in otensor:
+            tstart, tstep = otensor['scales'][self.oaxes.index('time')]
+            otensor['scales'][self.oaxes.index('time')] = [tstart,
+                                                           tstep*self.nint]
+            # Note: Without fftshift the fine channels are in FFT order (DC
+            #     first), which no linear frequency axis describes.
+            ifreq = self.oaxes.index('freq')
+            if self.fftshift:
+                nfreq = otensor['shape'][ifreq]
+                fstep = otensor['scales'][ifreq][1]
+                otensor['scales'][ifreq] = [-(nfreq // 2) * fstep, fstep]
+            else:
+                otensor['scales'][ifreq] = None
+        self.npol = npol
+        if self.nbit == 32:
+            self.stokes_code = stokes_i_func(self.ilabels, self.npol,
+                                             self.nint)
+        else:
+            nchan = otensor['shape'][self.oaxes.index('channel')]
+            self.nfreq = otensor['shape'][self.oaxes.index('freq')]
+            if new_layout:
+                # Per-channel running stats, and each gulp's partial sums
+                self.stats = bf.ndarray(shape=(nchan, 2), dtype='f64',
+                                        space='cuda')
+                self.partial_stats = bf.ndarray(
+                    shape=(nchan, STOKES_I_STATS_NSPLIT, 2), dtype='f64',
+                    space='cuda')
+            self.seeded = False
         return ohdr
+    def release_plan(self):
+        """ Return the FFT plan in use (if any) to the cache """
+        if self._fft_plan is not None:
+            release_fft_plan(self._fft_plan_key, self._fft_plan)
+        self._fft_plan_key = None
+        self._fft_plan = None
+    def on_sequence_end(self, iseq):
+        self.release_plan()
+    def prepare_gulp(self, idata, odata):
+        """ Set up the scratch views and FFT plan for a gulp shape
+
+        These depend only on the gulp shape and the input layout, so this
+        only runs again for the short last gulp of a file or a new layout.
+        """
+        nframe = idata.shape[0]
+        if self.reorder:
+            if self.voltages is None or self.voltages.shape[0] < nframe:
+                self.voltages = bf.ndarray(
+                    shape=[idata.shape[i] for i in self.vperm],
+                    dtype=self.idtype, space='cuda')
+            voltages = self.voltages[:nframe]
+            self.reorder_shape = list(voltages.shape)
+            del self.reorder_shape[self.ilabels.index('pol')]
+            self.gulp_voltages = voltages
+        else:
+            voltages = idata
+        if self.spectra is None or self.spectra.shape[0] < nframe:
+            self.spectra = bf.ndarray(shape=voltages.shape, dtype='cf32',
+                                      space='cuda')
+        spectra = self.spectra[:nframe]
+        # Note: The gulp shape changes at the end of each file, so keep
+        #     reusing plans across sequences rather than rebuilding.
+        key = fft_plan_key(voltages, spectra, self.fft_axis_indices,
+                           self.fftshift)
+        if key != self._fft_plan_key:
+            self.release_plan()
+            self._fft_plan = acquire_fft_plan(key, voltages, spectra)
+            self._fft_plan_key = key
+        self.gulp_plan_key = key
+        if self.nbit == 8:
+            (self.seed_code, self.quantize_code,
+             self.update_code) = stokes_i_8bit_funcs(
+                 self.ilabels, self.npol, self.nint, odata.shape[1],
+                 self.nfreq, self.fftshift)
+        self.gulp_spectra = spectra
+        self.prepared_nframe = nframe
     def on_data(self, ispan, ospan):
         idata = ispan.data
-        odata = ospan.data
-        #print ospan.data.shape, ispan.data.shape
+        if idata.shape[0] < self.nint:
+            # Note: A tail gulp shorter than nint has no output frames
+            return
+        if idata.shape[0] != self.prepared_nframe:
+            self.prepare_gulp(idata, ospan.data)
+        spectra = self.gulp_spectra
+        if not self.reorder:
+            voltages = idata
+        elif self.reorder_func is None:
+            voltages = self.gulp_voltages
+            bf_transpose(voltages, idata, self.vperm)
+        else:
+            voltages = self.gulp_voltages
+            bf.map(
+                self.reorder_func,
+                self.reorder_shape,
+                *self.reorder_axes,
+                a=idata,
+                b=voltages)
+        if self._fft_plan is None:
+            # Note: The plan goes back to the cache at each sequence end
+            self._fft_plan = acquire_fft_plan(self.gulp_plan_key, voltages,
+                                              spectra)
+            self._fft_plan_key = self.gulp_plan_key
+        self._fft_plan.execute(voltages, spectra)
+        if self.nbit == 32:
+            bf.map(
+                self.stokes_code,
+                ospan.data.shape,
+                'c', 't', 'p', 'f',
+                a=spectra,
+                b=ospan.data)
+        else:
+            nchan = ospan.data.shape[0]
+            if not self.seeded:
+                bf.map(
+                    self.seed_code,
+                    (nchan, STOKES_I_STATS_NSPLIT),
+                    'c', 'j',
+                    a=spectra,
+                    p=self.partial_stats)
+                self.update_stats(1.)
+                self.seeded = True
+            bf.map(
+                self.quantize_code,
+                (nchan, STOKES_I_STATS_NSPLIT),
+                'c', 'j',
+                a=spectra,
+                b=ospan.data,
+                s=self.stats,
+                p=self.partial_stats)
+            self.update_stats(STOKES_I_STATS_WEIGHT)
+    def update_stats(self, weight):
+        """ Fold the partial sums of the last kernel into the running stats """
         bf.map(
-            "b(i, j, k, l) = a(i, j, k, l)",
-            ospan.data.shape,
-            'i', 'j', 'k', 'l',
-            a=ispan.data,
-            b=ospan.data)
+            self.update_code,
+            (self.stats.shape[0],),
+            'c',
+            p=self.partial_stats,
+            s=self.stats,
+            w=weight)
+
+def fft_stokes_i(iring, axes, *args, **kwargs):
+    return FftStokesIBlock(iring, axes, *args, **kwargs)
+
+
+# O_DIRECT needs buffer addresses, sizes and file offsets aligned to this
+DIRECT_IO_ALIGN_NBYTE = 4096
+
+class DirectFileWriter(object):
+    def __init__(self, filename, buffer_nbyte=4*1024**2):
+        """ Sequential file writer that coalesces writes for O_DIRECT
+
+        Data is staged in a page-aligned buffer and written with one pwrite
+        per buffer-full, bypassing the page cache. Only whole multiples of
+        DIRECT_IO_ALIGN_NBYTE are written until close(), which writes the
+        unaligned tail without O_DIRECT. Falls back to normal writes where
+        O_DIRECT is not supported (e.g., tmpfs).
+        """
+        align = DIRECT_IO_ALIGN_NBYTE
+        buffer_nbyte = max(buffer_nbyte // align * align, align)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        self.direct = hasattr(os, 'O_DIRECT')
+        self.fd = None
+        if self.direct:
+            try:
+                self.fd = os.open(filename, flags | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self.direct = False
+        if self.fd is None:
+            self.fd = os.open(filename, flags)
+        # Note: Anonymous mappings are always page-aligned
+        self.buf = mmap.mmap(-1, buffer_nbyte)
+        self.fill = 0
+        self.offset = 0
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        while len(data):
+            nbyte = min(len(data), len(self.buf) - self.fill)
+            self.buf[self.fill:self.fill+nbyte] = data[:nbyte]
+            self.fill += nbyte
+            data = data[nbyte:]
+            if self.fill == len(self.buf):
+                self._flush()
+    def _disable_direct(self):
+        if self.direct:
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            self.direct = False
+    def _flush(self, final=False):
+        align = DIRECT_IO_ALIGN_NBYTE
+        nbyte = self.fill if final else self.fill // align * align
+        if nbyte % align:
+            self._disable_direct()
+        nwritten = 0
+        with memoryview(self.buf) as view:
+            while nwritten < nbyte:
+                try:
+                    with view[nwritten:nbyte] as chunk:
+                        nwritten += os.pwrite(self.fd, chunk,
+                                              self.offset + nwritten)
+                except OSError as e:
+                    # Some filesystems only reject O_DIRECT at write time
+                    if e.errno != errno.EINVAL or not self.direct:
+                        raise
+                    self._disable_direct()
+        self.buf.move(0, nbyte, self.fill - nbyte)
+        self.fill -= nbyte
+        self.offset += nbyte
+    def close(self):
+        try:
+            self._flush(final=True)
+        finally:
+            os.close(self.fd)
+            self.buf.close()
+
+class SigprocFilterbankSinkBlock(bfp.SinkBlock):
+    def __init__(self, iring, path='', buffer_nbyte=4*1024**2,
+                 *args, **kwargs):
+        """ Write [beam, time, pol, freq] data as one filterbank per beam """
+        super(SigprocFilterbankSinkBlock, self).__init__(iring, *args,
+                                                         **kwargs)
+        self.path = path
+        self.buffer_nbyte = buffer_nbyte
+        self.writers = []
+    def define_valid_input_spaces(self):
+        """Return set of valid spaces (or 'any') for each input"""
+        return ('system',)
+    def close_files(self):
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+    def on_sequence(self, iseq):
+        self.close_files()
+        ihdr = iseq.header
+        itensor = ihdr['_tensor']
+        if itensor['labels'] != ['beam', 'time', 'pol', 'freq']:
+            raise ValueError("Expected [beam, time, pol, freq] input, got %s" %
+                             itensor['labels'])
+        nbeam, _, npol, nchan = itensor['shape']
+        beam_scale, time_scale, _, freq_scale = itensor['scales']
+        beam_units, time_units, _, freq_units = itensor['units']
+        if freq_scale is None:
+            raise ValueError("Input has no linear frequency axis")
+        fch1 = convert_units(freq_scale[0], freq_units, 'MHz')
+        sigproc_hdr = {
+            'data_type':    1, # Filterbank
+            'nbits':        DataType(itensor['dtype']).itemsize_bits,
+            'tstart':       time_scale[0] / 86400. + 40587,
+            'tsamp':        convert_units(time_scale[1], time_units, 's'),
+            'foff':         convert_units(freq_scale[1], freq_units, 'MHz'),
+            'nchans':       nchan,
+            'nifs':         npol,
+            'nbeams':       nbeam,
+        }
+        # Note: Optional entries are copied as blocks.write_sigproc does
+        for key, sigproc_key in [('source_name', 'source_name'),
+                                 ('rawdatafile', 'rawdatafile'),
+                                 ('az_start', 'az_start'),
+                                 ('za_start', 'za_start'),
+                                 ('raj', 'src_raj'),
+                                 ('dej', 'src_dej')]:
+            if ihdr.get(key) is not None:
+                sigproc_hdr[sigproc_key] = ihdr[key]
+        if ihdr.get('telescope') is not None:
+            sigproc_hdr['telescope_id'] = sigproc.telescope2id(
+                ihdr['telescope'])
+        if ihdr.get('machine') is not None:
+            sigproc_hdr['machine_id'] = sigproc.machine2id(ihdr['machine'])
+        if ihdr.get('refdm') is not None:
+            sigproc_hdr['refdm'] = convert_units(ihdr['refdm'],
+                                                 ihdr['refdm_units'],
+                                                 'pc cm^-3')
+        basename = os.path.splitext(os.path.basename(ihdr['name']))[0]
+        for beam in range(nbeam):
+            # Note: Each beam is one coarse channel, and fch1 is the
+            #     frequency of its first fine channel
+            sigproc_hdr['ibeam'] = beam
+            sigproc_hdr['fch1'] = (
+                convert_units(beam_scale[0] + beam*beam_scale[1],
+                              beam_units, 'MHz') + fch1
+                if beam_scale is not None else fch1)
+            filename = os.path.join(self.path,
+                                    '%s.%04i.fil' % (basename, beam))
+            writer = DirectFileWriter(filename, self.buffer_nbyte)
+            sigproc.write_header(sigproc_hdr, writer)
+            self.writers.append(writer)
+    def on_sequence_end(self, iseq):
+        self.close_files()
+    def on_data(self, ispan):
+        for beam, writer in enumerate(self.writers):
+            writer.write(ispan.data[beam])
+
+def write_sigproc_filterbanks(iring, *args, **kwargs):
+    return SigprocFilterbankSinkBlock(iring, *args, **kwargs)
 
-def grab_first(iring, axis=0):
-    return GrabFirstBlock(iring, axis)
 
+# Number of GUPPI blocks per gulp. All nchan*npol transforms of every block
+#   in a gulp go into a single batched cuFFT call, so larger gulps keep the
+#   GPU busier.
+gulp_nframe = 4
+# Depth of the rings, in gulps. With more than one gulp per ring, each
+#   block can start on the next gulp while its consumer is still busy, so
+#   the read, the H2D copy and the reorder + FFT + detect (each on its own
+#   block thread and CUDA stream) overlap instead of running in lockstep.
+#   Each block in a gulp then needs ~9x BLOCSIZE of GPU memory (~1.2 GB for
+#   128 MiB blocks).
+# Note: A block's buffer_nframe sizes its input ring, in input frames.
+buffer_ngulp = 3
+# Number of GUPPI blocks integrated into each output spectrum. Must divide
+#   gulp_nframe.
+nint = 1
+assert gulp_nframe % nint == 0
 
 with bfp.Pipeline() as pipeline:
-    raw_guppi = new_read_guppi_raw(['blc1_guppi_57388_HIP113357_0010.0000.raw'], buffer_nframe=1)
-    g_guppi = blocks.copy(raw_guppi, space='cuda', buffer_nframe=1)
-    ffted = blocks.fft(g_guppi, axes='fine_time', axis_labels='freq', buffer_nframe=1)
-    modulo = blocks.detect(ffted, mode='stokes', buffer_nframe=1)
-    # Take I
-    first_element = grab_first(modulo, 0)
-    transposed = blocks.transpose(first_element, ['channel', 'time', 'pol', 'freq'])
-    renamed = views.rename_axis(transposed, 'channel', 'beam')
+    raw_guppi = new_read_guppi_raw(['blc1_guppi_57388_HIP113357_0010.0000.raw'], gulp_nframe=gulp_nframe)
+    # Note: This sizes the pinned source ring, so the source can fill the
+    #     next gulps while earlier ones are being copied to the GPU.
+    g_guppi = blocks.copy(raw_guppi, space='cuda', buffer_nframe=buffer_ngulp*gulp_nframe)
+    # Reorder to pol-major so each pol's fine_time series has unit stride,
+    #   FFT, then detect, take I and transpose to [channel, time, pol, freq],
+    #   integrating nint blocks per spectrum, all within one block. Output
+    #   8-bit filterbanks, as rawspec does.
+    stokes_i = fft_stokes_i(g_guppi, axes='fine_time', axis_labels='freq', apply_fftshift=True, nbit=8, nint=nint, buffer_nframe=buffer_ngulp*gulp_nframe)
+    renamed = views.rename_axis(stokes_i, 'channel', 'beam')
     blocks.print_header(renamed)
-    blocks.write_sigproc(renamed)
+    h_renamed = blocks.copy(renamed, space='cuda_host', buffer_nframe=buffer_ngulp*gulp_nframe//nint)
+    write_sigproc_filterbanks(h_renamed)
     pipeline.run()